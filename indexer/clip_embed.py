@@ -4,53 +4,146 @@ CLIP Text Embedding Helper
 Converts text queries to CLIP embeddings for image search.
 """
 
+import os
 import sys
 import json
+import functools
+import hashlib
+import socketserver
+import tempfile
+import threading
 from pathlib import Path
-import torch
-from transformers import CLIPProcessor, CLIPModel
+import numpy as np
 
-# Global CLIP model cache
-_clip_model = None
-_clip_processor = None
+from clip_shared import get_clip
 
-def get_clip_model():
-    """Get or initialize CLIP model and processor."""
-    global _clip_model, _clip_processor
-    
-    if _clip_model is None or _clip_processor is None:
-        model_name = "openai/clip-vit-base-patch32"
-        _clip_model = CLIPModel.from_pretrained(model_name)
-        _clip_processor = CLIPProcessor.from_pretrained(model_name)
-        
-        # Use CPU if CUDA is not available
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        _clip_model = _clip_model.to(device)
-        _clip_model.eval()
-    
-    return _clip_model, _clip_processor
+# Optional Rust tokenizer, much faster than CLIPTokenizerFast for short queries
+try:
+    from instant_clip_tokenizer import Tokenizer as InstantClipTokenizer
+except ImportError:
+    InstantClipTokenizer = None
+
+CLIP_CONTEXT_LENGTH = 77
+CLIP_EMBED_DIM = 512
+
+# Unix socket for the long-lived `--serve` mode
+SOCKET_PATH = "/tmp/indexchat-clip.sock"
+
+# On-disk cache of text embeddings, keyed by sha256 of the query
+TEXT_CACHE_DIR = Path.home() / ".cache" / "indexchat" / "clip_text"
+
+_fast_tokenizer = InstantClipTokenizer() if InstantClipTokenizer else None
 
+# The compiled text tower replays CUDA graphs whose output buffers are reused,
+# so concurrent `--serve` handler threads must not overlap forward passes
+_forward_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1024)
 def get_text_embedding(text: str) -> list[float]:
     """Get CLIP text embedding for a query string."""
-    model, processor = get_clip_model()
+    # Cache hits skip both the model load and the forward pass
+    cache_path = TEXT_CACHE_DIR / f"{hashlib.sha256(text.encode()).hexdigest()}.f16.bin"
+    try:
+        cached = np.fromfile(cache_path, dtype=np.float16)
+    except OSError:
+        cached = None
+    # A short file is a leftover from an interrupted write; treat it as a miss
+    if cached is not None and cached.size == CLIP_EMBED_DIM:
+        return cached.astype(np.float32).tolist()
+    
+    import torch
+    model, processor, device = get_clip()
     
     # Process text
-    inputs = processor(text=[text], return_tensors="pt", padding=True, truncation=True)
+    if _fast_tokenizer is not None:
+        # BOS/EOS added, truncated to 77 and zero-padded
+        token_ids = _fast_tokenizer.tokenize_batch([text], context_length=CLIP_CONTEXT_LENGTH)
+        input_ids = torch.from_numpy(token_ids.astype(np.int64))
+        inputs = {"input_ids": input_ids, "attention_mask": (input_ids != 0).long()}
+    else:
+        # Fixed 77-token shape, matching the shape the compiled text tower is warmed up with
+        inputs = processor.tokenizer(
+            [text], return_tensors="pt", padding="max_length", max_length=CLIP_CONTEXT_LENGTH, truncation=True
+        )
     
     # Move inputs to same device as model
-    device = next(model.parameters()).device
     inputs = {k: v.to(device) for k, v in inputs.items()}
     
     # Get text embedding
-    with torch.no_grad():
-        text_features = model.get_text_features(**inputs)
+    with _forward_lock, torch.inference_mode():
+        text_features = model.get_text_features(**inputs).float()
         # Normalize the embedding
         text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        embedding = text_features[0].cpu().numpy().tolist()
+        embedding = text_features[0].cpu().numpy()
+    
+    # Temp file + rename: `--serve` handler threads may read this entry concurrently
+    try:
+        TEXT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=TEXT_CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(embedding.astype(np.float16).tobytes())
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            os.unlink(tmp_path)
+    except OSError:
+        pass
     
-    return embedding
+    return embedding.tolist()
+
+def compile_text_tower():
+    """torch.compile the text tower and warm it up at the fixed 77-token shape.
+
+    Only worth it for the long-lived `--serve` process; falls back to eager on failure.
+    """
+    import torch
+    model, _, device = get_clip()
+    if not hasattr(torch, "compile"):
+        return
+    
+    eager_text_features = model.get_text_features
+    try:
+        model.get_text_features = torch.compile(eager_text_features, mode="reduce-overhead", fullgraph=False)
+        dummy_ids = torch.zeros(1, CLIP_CONTEXT_LENGTH, dtype=torch.long, device=device)
+        with torch.inference_mode():
+            model.get_text_features(input_ids=dummy_ids, attention_mask=torch.ones_like(dummy_ids))
+    except Exception as e:
+        print(f"torch.compile unavailable, using eager CLIP: {e}", file=sys.stderr)
+        model.get_text_features = eager_text_features
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """One query per line in, one JSON embedding per line out."""
+    
+    def handle(self):
+        for line in self.rfile:
+            query = line.decode("utf-8").rstrip("\r\n")
+            try:
+                embedding = get_text_embedding(query)
+            except Exception:
+                embedding = []
+            self.wfile.write((json.dumps(embedding) + "\n").encode("utf-8"))
+
+def serve(socket_path: str = SOCKET_PATH):
+    """Keep the CLIP model resident and answer queries over a Unix socket."""
+    get_clip()
+    compile_text_tower()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    with socketserver.ThreadingUnixStreamServer(socket_path, QueryHandler) as server:
+        print(f"CLIP embedding server listening on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
 
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--serve":
+        serve()
+        sys.exit(0)
+    
     if len(sys.argv) < 2:
         print(json.dumps([]), file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,42 @@
+"""
+Shared CLIP Model
+Loads CLIP once per process for both query embedding (clip_embed.py)
+and image indexing (indexer.py).
+"""
+
+import functools
+import os
+
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+
+@functools.lru_cache(maxsize=1)
+def get_clip():
+    """Get (model, processor, device), loading CLIP on first use."""
+    # Deferred so callers that never embed don't import torch
+    import torch
+    from transformers import CLIPProcessor, CLIPModel
+    
+    model = CLIPModel.from_pretrained(CLIP_MODEL_NAME)
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+    
+    # Prefer CUDA, then Apple Silicon (MPS), then CPU
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.backends.mps.is_available():
+        device = "mps"
+    else:
+        device = "cpu"
+        torch.set_num_threads(os.cpu_count())
+    # Allow TF32 / reduced-precision matmuls for the remaining FP32 work
+    torch.set_float32_matmul_precision("high")
+    
+    model = model.to(device)
+    model.eval()
+    
+    # FP16 on CUDA, INT8 dynamic-quantized linear layers on CPU
+    if device == "cuda":
+        model = model.half()
+    elif device == "cpu":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    return model, processor, device
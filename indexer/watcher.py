@@ -4,101 +4,109 @@ IndexChat PDF & Image Watcher
 Watches the input directory for documents and image changes and triggers reindexing.
 """
 
-import subprocess
-import sys
+import os
 import time
 from pathlib import Path
-from threading import Timer
+from threading import Event, Thread
 
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, FileSystemEvent
+from watchdog.observers.polling import PollingObserver
+from watchdog.events import (
+    EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED,
+    FileSystemEventHandler, FileSystemEvent,
+)
+
+# Imported once, so rebuilds don't pay interpreter startup and heavy imports every time
+from indexer import build_index, DOC_EXTENSIONS, IMAGE_EXTENSIONS, AUDIO_EXTENSIONS, VIDEO_EXTENSIONS
 
 # Configuration
 INPUT_DIR = Path(__file__).parent.parent / "input"
-INDEXER_SCRIPT = Path(__file__).parent / "indexer.py"
 DEBOUNCE_SECONDS = 2.0
+# Native events don't reach us on network / container mounts; set to poll instead
+FORCE_POLLING = os.getenv("INDEXCHAT_WATCH_POLLING") == "1"
 
-# Supported file extensions
-DOC_EXTENSIONS = {".pdf", ".docx", ".pptx", ".txt", ".md"}
-IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"}
-AUDIO_EXTENSIONS = {".mp3", ".wav", ".m4a"}
-VIDEO_EXTENSIONS = {".mp4", ".mov", ".avi"}
+# Supported file extensions, shared with the indexer
 WATCHED_EXTENSIONS = DOC_EXTENSIONS | IMAGE_EXTENSIONS | AUDIO_EXTENSIONS | VIDEO_EXTENSIONS
+# Open/close events (inotify) don't change content
+WATCHED_EVENTS = {EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_DELETED, EVENT_TYPE_MOVED}
+# Hidden files and Office lock files (~$report.docx); editor temp files
+# (*.swp, *.tmp, *~, *.part) already fail the extension check
+IGNORED_PREFIXES = (".", "~$")
 
 
 class FileWatcherHandler(FileSystemEventHandler):
     """Handler for file system events with debouncing."""
     
-    def __init__(self):
+    def __init__(self, extensions: set[str] = WATCHED_EXTENSIONS):
         super().__init__()
-        self._timer: Timer | None = None
-        self._is_rebuilding = False
+        self.extensions = extensions
+        # (st_mtime_ns, st_size) per path, to drop modify events that changed nothing
+        self._stats: dict[str, tuple[int, int]] = {}
+        self._wake = Event()
+        # One long-lived worker debounces events and runs rebuilds, one at a time
+        Thread(target=self._debounce_loop, daemon=True).start()
+    
+    def _is_watched_path(self, path: str) -> bool:
+        name = Path(path).name
+        return Path(name).suffix.lower() in self.extensions and not name.startswith(IGNORED_PREFIXES)
     
     def _is_watched_file(self, event: FileSystemEvent) -> bool:
         """Check if the event is related to a watched file."""
         if event.is_directory:
             return False
-        src_path = Path(event.src_path)
-        return src_path.suffix.lower() in WATCHED_EXTENSIONS
+        # Atomic saves write a temp file and rename it over the real one
+        dest_path = getattr(event, "dest_path", "")
+        return self._is_watched_path(event.src_path) or bool(dest_path) and self._is_watched_path(dest_path)
+    
+    def _is_content_change(self, event: FileSystemEvent) -> bool:
+        """False for a repeated modify event whose mtime and size match the last one seen."""
+        if event.event_type == EVENT_TYPE_DELETED:
+            self._stats.pop(event.src_path, None)
+            return True
+        path = getattr(event, "dest_path", "") or event.src_path
+        try:
+            st = os.stat(path)
+        except OSError:
+            return True
+        stat_key = (st.st_mtime_ns, st.st_size)
+        unchanged = self._stats.get(path) == stat_key
+        self._stats[path] = stat_key
+        return not (event.event_type == EVENT_TYPE_MODIFIED and unchanged)
     
     def _schedule_rebuild(self):
         """Schedule a rebuild with debouncing."""
-        if self._timer is not None:
-            self._timer.cancel()
-        
-        self._timer = Timer(DEBOUNCE_SECONDS, self._run_rebuild)
-        self._timer.start()
-        print(f"Rebuild scheduled in {DEBOUNCE_SECONDS} seconds...")
+        self._wake.set()
+    
+    def _debounce_loop(self):
+        """Wait for an event, then for DEBOUNCE_SECONDS without further events, then rebuild."""
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            print(f"Rebuild scheduled in {DEBOUNCE_SECONDS} seconds...")
+            while self._wake.wait(DEBOUNCE_SECONDS):
+                self._wake.clear()
+            # Events arriving during the rebuild leave _wake set and trigger another one
+            self._run_rebuild()
     
     def _run_rebuild(self):
         """Run the indexer rebuild."""
-        if self._is_rebuilding:
-            print("Rebuild already in progress, skipping...")
-            return
-        
-        self._is_rebuilding = True
         print("\n" + "=" * 50)
         print("Rebuilding index...")
         print("=" * 50 + "\n")
         
         try:
-            result = subprocess.run(
-                [sys.executable, str(INDEXER_SCRIPT), "--build"],
-                capture_output=False,
-                text=True
-            )
-            if result.returncode == 0:
-                print("\nIndex rebuild completed successfully!")
-            else:
-                print(f"\nIndex rebuild failed with code {result.returncode}")
+            # Runs on the debounce worker, so the observer keeps receiving events
+            build_index()
+            print("\nIndex rebuild completed successfully!")
         except Exception as e:
             print(f"\nError running indexer: {e}")
         finally:
-            self._is_rebuilding = False
             print("\nWatching for changes...")
     
-    def on_created(self, event: FileSystemEvent):
-        """Handle file creation."""
-        if self._is_watched_file(event):
-            print(f"File created: {Path(event.src_path).name}")
-            self._schedule_rebuild()
-    
-    def on_modified(self, event: FileSystemEvent):
-        """Handle file modification."""
-        if self._is_watched_file(event):
-            print(f"File modified: {Path(event.src_path).name}")
-            self._schedule_rebuild()
-    
-    def on_deleted(self, event: FileSystemEvent):
-        """Handle file deletion."""
-        if self._is_watched_file(event):
-            print(f"File deleted: {Path(event.src_path).name}")
-            self._schedule_rebuild()
-    
-    def on_moved(self, event: FileSystemEvent):
-        """Handle file move/rename."""
-        if self._is_watched_file(event):
-            print(f"File moved: {Path(event.src_path).name}")
+    def on_any_event(self, event: FileSystemEvent):
+        """Handle file creation, modification, deletion and move/rename."""
+        if event.event_type in WATCHED_EVENTS and self._is_watched_file(event) and self._is_content_change(event):
+            print(f"File {event.event_type}: {Path(getattr(event, 'dest_path', '') or event.src_path).name}")
             self._schedule_rebuild()
 
 
@@ -117,9 +125,16 @@ def main():
     
     # Set up the observer
     event_handler = FileWatcherHandler()
-    observer = Observer()
+    observer = PollingObserver() if FORCE_POLLING else Observer()
     observer.schedule(event_handler, str(INPUT_DIR), recursive=False)
-    observer.start()
+    try:
+        observer.start()
+    except OSError as e:
+        # e.g. inotify watch/instance limits reached
+        print(f"Native file events unavailable ({e}), falling back to polling")
+        observer = PollingObserver()
+        observer.schedule(event_handler, str(INPUT_DIR), recursive=False)
+        observer.start()
     
     try:
         while True:
@@ -83,8 +83,32 @@ async function getClapTextEmbedding(query) {
   }
 }
 
-function deserializeEmbedding(buffer) {
+// IEEE 754 half precision -> number
+function halfToFloat(h) {
+  const sign = h & 0x8000 ? -1 : 1;
+  const exp = (h >> 10) & 0x1f;
+  const frac = h & 0x3ff;
+  if (exp === 0) return sign * frac * 2 ** -24;
+  if (exp === 0x1f) return frac ? NaN : sign * Infinity;
+  return sign * (1 + frac / 1024) * 2 ** (exp - 15);
+}
+
+function deserializeEmbedding(buffer, dtype = "float32") {
   const floats = [];
+  if (dtype === "int8") {
+    // 4-byte float32 scale, then one signed byte per dimension
+    const scale = buffer.readFloatLE(0);
+    for (let i = 4; i < buffer.length; i++) {
+      floats.push(buffer.readInt8(i) * scale);
+    }
+    return floats;
+  }
+  if (dtype === "float16") {
+    for (let i = 0; i < buffer.length; i += 2) {
+      floats.push(halfToFloat(buffer.readUInt16LE(i)));
+    }
+    return floats;
+  }
   for (let i = 0; i < buffer.length; i += 4) {
     floats.push(buffer.readFloatLE(i));
   }
@@ -146,9 +170,9 @@ function searchTable(db, tableName, queryEmbedding, type, topK, dim) {
   }
 
   // Fallback Brute Force
-  const docs = db.prepare(`SELECT id, file_name, content_type, chunk_text, embedding, metadata FROM documents WHERE content_type = ?`).all(type);
+  const docs = db.prepare(`SELECT id, file_name, content_type, chunk_text, embedding, embedding_dtype, metadata FROM documents WHERE content_type = ?`).all(type);
   const sims = docs.map(doc => {
-    const emb = deserializeEmbedding(doc.embedding);
+    const emb = deserializeEmbedding(doc.embedding, doc.embedding_dtype);
     // Safety check dim
     if (emb.length !== dim) return null;
     return {